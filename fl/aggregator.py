@@ -1,13 +1,101 @@
 import torch
-from math import log
 import numpy as np
 from fl.models import NumpyModel
-from fl.data_utils import sum_model_L2_distance
+from fl.data_utils import pairwise_sum_L2_distance, binary_mutual_info
+
+def _nesterov_step(w, m, g, beta, lr, tmp):
+    """
+    Nesterov momentum step on the flat buffers, updating m and w in place:
+    m = beta * m_prev - lr * g, w += - beta * m_prev + (1 + beta) * m. The
+    elementwise ops run in the same fixed order on every node (no fused or
+    reordered arithmetic), so validators recompute the exact same bits.
+    Args:
+    - w:        {np.ndarray} the flat global model parameters
+    - m:        {np.ndarray} the flat momentum of last round
+    - g:        {np.ndarray} the flat aggregated updates, used as scratch space (overwritten)
+    - beta:     {float} the momentum hyperparameter
+    - lr:       {float} the server side learning rate
+    - tmp:      {np.ndarray} scratch space of the shape and dtype of w
+    """
+    np.multiply(m, -beta, out=tmp)      # - beta * m_prev
+    np.multiply(g, lr, out=g)           # lr * g
+    np.multiply(m, beta, out=m)
+    np.subtract(m, g, out=m)            # m = beta * m_prev - lr * g
+    np.multiply(m, 1 + beta, out=g)     # (1 + beta) * m
+    np.add(tmp, g, out=tmp)
+    np.add(w, tmp, out=w)
+
+def _flat_copy(params):
+    """
+    Args:
+    - params:   {list of np.ndarray} model parameters
+
+    Returns: {np.ndarray} a new 1-D array holding the values of params, copied once
+    """
+    model = NumpyModel(params)
+    return model.flat if model.flat is not None else model.to_flat()
+
+def _weighted_mean(G, w, out=None, tmp=None):
+    """
+    The weighted rows are added one at a time, in a fixed order and in the 
+    dtype of G, so every node recomputing an aggregation gets the same bits 
+    whatever its CPU, BLAS or thread count.
+    Args:
+    - G:        {np.ndarray} of shape [N, P], as returned by ServerAgg._stack_grads
+    - w:        {np.ndarray} of shape [N], the weight of each row, summing to 1, 0 for filtered out clients
+    - out:      {np.ndarray} of shape [P] and the dtype of G, where to write the result
+    - tmp:      {np.ndarray} of shape [P] and the dtype of G, scratch space
+
+    Returns: {np.ndarray} of shape [P], the weighted mean of the rows of G
+    """
+    if out is None:
+        out = np.empty(G.shape[1], dtype=G.dtype)
+    if tmp is None:
+        tmp = np.empty_like(out)
+    w = np.asarray(w, dtype=G.dtype)
+
+    out.fill(0.0)
+    for n in np.flatnonzero(w):
+        np.multiply(G[n], w[n], out=tmp)
+        out += tmp
+    return out
 
 class ServerAgg():
+    _G = None   # the flat matrix of clients' updates, reused by repeated apply_gradients calls
+
     def apply_gradients(self, grads):
         raise NotImplementedError()
 
+    def _stack_grads(self, clients_grads):
+        """
+        Copy the clients' updates into the flat matrix self._G. The matrix is
+        kept for the lifetime of the aggregator and only reallocated when it is
+        too small for the clients passed in, so an aggregator that is reused 
+        across rounds (e.g. FedAvg, Bicotti) allocates it once. MI instances 
+        built per round by interact.node_run allocate it each round.
+        Args:
+        - clients_grads:    {list of NumpyModel} each contains a client's model updates
+
+        Returns:
+            - G             {np.ndarray} of shape [N, P] in the dtype of the global model, row i is the flattened updates of client i
+        """
+        N = len(clients_grads)
+        sizes = [np.size(p) for p in clients_grads[0]]
+        P = sum(sizes)
+        if self._G is None or self._G.shape[0] < N or self._G.shape[1] != P:
+            self._G = np.empty(shape=(N, P), dtype=self._flat_params.dtype)
+
+        G = self._G[:N]
+        for i, client_grads in enumerate(clients_grads):
+            if isinstance(client_grads, NumpyModel) and client_grads.flat is not None:
+                G[i] = client_grads.flat
+                continue
+            offset = 0
+            for p, size in zip(client_grads, sizes):
+                G[i, offset:offset+size] = np.ravel(p)
+                offset += size
+        return G
+
 class FedAvg(ServerAgg):
     def __init__(self, global_model, beta, slr):
         """
@@ -17,12 +105,16 @@ class FedAvg(ServerAgg):
         - beta:                      {float} the hyperparameter when the compress mode is on
         - slr:                       {float} the server side learning rate
         """
-        self.global_model = NumpyModel(global_model)
+        self.shapes = [np.shape(p) for p in global_model]
+        self._flat_params = _flat_copy(global_model)
+        self.global_model = NumpyModel.from_flat(self._flat_params, self.shapes)
         self.beta = beta
         self.lr = slr
         self.m = self.global_model.zeros_like()
+        self._agg_buf = np.zeros_like(self._flat_params) # reused by repeated apply_gradients calls
+        self._tmp_buf = np.zeros_like(self._flat_params)
 
-    def apply_gradients(self, clients_grads):
+    def apply_gradients(self, clients_grads, weights=None):
         """
         Args:
         - client_grads：             if compress == False:
@@ -30,23 +122,33 @@ class FedAvg(ServerAgg):
                                     if compress == True:
                                         {list of list of np.ndarrays} the compressed grads of each client
         - global_model:              {list of np.ndarray} the global model parameters of last round
+        - weights:                   {np.ndarray} the weight of each client, e.g. its number of samples, None for a plain average
 
         Returns:
             -round_agg      {NumpyModel} the aggregated global model for next round training
         """
         self.clients_grads = clients_grads
 
-        round_agg = self.global_model.zeros_like()
-        for client_grads in self.clients_grads:
-            round_agg += client_grads
+        G = self._stack_grads(self.clients_grads)
         N = len(self.clients_grads)
-        round_agg = round_agg / N
+        if weights is None:
+            w = np.full(N, 1 / N)
+        else:
+            w = np.asarray(weights, dtype=np.float64)
+            if w.shape != (N,):
+                raise ValueError("Expected one weight per client")
+            if not np.all(np.isfinite(w)) or np.any(w < 0) or w.sum() <= 0:
+                raise ValueError("Client weights must be finite, non-negative and not all zero")
+            w = w / w.sum()
+        round_agg = _weighted_mean(G, w, out=self._agg_buf, tmp=self._tmp_buf)
 
-        self.global_model += - self.lr * round_agg
-        return self.global_model
+        round_agg *= self.lr
+        self._flat_params -= round_agg
+        # a snapshot, the internal buffer keeps changing with later rounds
+        return self.global_model.copy()
 
 class MI(ServerAgg):
-    def __init__(self, global_model, unlabeled_data, model, beta, slr, m_prev):
+    def __init__(self, global_model, unlabeled_data, model, beta, slr, m_prev, estimator='gaussian', out_dtype=None):
         """
         Args:
         - client_grads：             if compress == False:
@@ -54,19 +156,37 @@ class MI(ServerAgg):
                                     if compress == True:
                                         {list of list of np.ndarrays} the compressed grads of each client
         - global_model:             {list of np.ndarray} the global model parameters of last round
-        - unlabeled_data:           {list of tensors} the unlabeled dataset, only contains x, no y included
+        - unlabeled_data:           {tensor, list of tensors} the unlabeled dataset, only contains x, no y included
         - model:                    {FLModel} the current task model
         - beta:                     {float} the hyperparameter when the compress mode is on
         - slr:                      {float} the server side learning rate
         - m_prev:                   {list of np.ndarray} the momentum value of last round
+        - estimator:                {string} 'gaussian' estimates the MI from the correlation of the model outputs,
+                                    'binary' from the joint histogram of the signs of the centred model outputs
+        - out_dtype:                {torch.dtype} the dtype the clients' normalised outputs are cached and correlated in, e.g.
+                                    torch.bfloat16 on GPU to halve their memory traffic at the cost of precision in rho,
+                                    None keeps the model's output dtype
         """
+        if estimator not in ('gaussian', 'binary'):
+            raise ValueError("Incorrect MI estimator")
 
-        self.global_model = NumpyModel(global_model)
-        self.unlabel = unlabeled_data
+        self.shapes = [np.shape(p) for p in global_model]
+        self._flat_params = _flat_copy(global_model)
+        self.global_model = NumpyModel.from_flat(self._flat_params, self.shapes)
+        if isinstance(unlabeled_data, (list, tuple)):
+            unlabeled_data = torch.stack(unlabeled_data)
+        # one contiguous tensor on the model's device, so the forward passes never restack or transfer it
+        self.unlabel = unlabeled_data.to(model.device).contiguous()
         self.model = model
-        self.m = NumpyModel(m_prev)
+        self._m_flat = _flat_copy(m_prev)
+        self.m = NumpyModel.from_flat(self._m_flat, self.shapes)
+        # the aggregation buffer lives as long as this aggregator, note interact.node_run builds a new MI each round
+        self._agg_buf = np.zeros_like(self._flat_params)
+        self._tmp_buf = np.zeros_like(self._flat_params)
         self.beta = beta
         self.lr = slr
+        self.estimator = estimator
+        self.out_dtype = out_dtype
 
     def apply_gradients(self, clients_grads):
         """
@@ -79,38 +199,55 @@ class MI(ServerAgg):
         """
         # server decompress gradients
         self.clients_grads = clients_grads
+        G = self._stack_grads(self.clients_grads)
+        N = len(self.clients_grads)
 
-        self.clients_model = []
-        for client_grads in self.clients_grads:
-            self.clients_model.append(self.global_model - client_grads) # model parameters of clients models
+        # clients whose update is not finite are never aggregated, their rows are zeroed so that
+        # the 0 weight below does not turn into 0 * nan
+        finite_rows = np.isfinite(G).all(axis=1)
+        idx = np.flatnonzero(finite_rows)
+        if len(idx) == 0:
+            raise ValueError("No finite client updates to aggregate")
+        G[~finite_rows] = 0
 
-        # Median based method
-        mutual_mis = self.get_mutual_mi()
-        MI = mutual_mis
+        # plain average of the remaining clients when the MI values carry no filtering signal: with 2 or
+        # fewer clients they are always identical, so the MI computation is skipped entirely
+        w = np.zeros(N)
+        w[idx] = 1 / len(idx)
+        if len(idx) > 2:
+            self.clients_model = []
+            for i in idx:
+                # model parameters of clients models
+                self.clients_model.append(NumpyModel.from_flat(self._flat_params - G[i], self.shapes))
 
-        # select client models, according to the "two-sigma edit" rule
-        MAD = np.median(abs(MI - np.median(MI)))  # get the median absolute deviation from median of MI values
-        MADN = MAD / 0.6745  # get the normalized MAD values, note 0.6745 is the MAD of a standard normal distribution
+            # Median based method
+            mutual_mis = self.get_mutual_mi()
+            MI = mutual_mis
 
-        ts = (MI - np.median(MI)) / MADN
-        select = []
-        for i in range(len(ts)):
-            if abs(ts[i]) < 2:
-                select.append(self.clients_grads[i])
+            # clients whose MI is not finite are dropped as well
+            finite = np.isfinite(MI)
+            if finite.any():
+                idx, MI = idx[finite], MI[finite]
+                w = np.zeros(N)
+                w[idx] = 1 / len(idx)
 
+                # select client models, according to the "two-sigma edit" rule
+                MAD = np.median(abs(MI - np.median(MI)))  # get the median absolute deviation from median of MI values
+                MADN = MAD / 0.6745  # get the normalized MAD values, note 0.6745 is the MAD of a standard normal distribution
 
-        round_agg = self.global_model.zeros_like()
-        for client_grads in select:
-            round_agg += client_grads
-        N = len(select)
-        round_agg = round_agg / N
+                if MADN > 1e-12:
+                    ts = (MI - np.median(MI)) / MADN
+                    select = np.abs(ts) < 2  # never empty, the clients nearest the median have |ts| <= 0.6745
+                    w = np.zeros(N)
+                    w[idx[select]] = 1 / select.sum()
+        round_agg = _weighted_mean(G, w, out=self._agg_buf, tmp=self._tmp_buf)
 
-        # Momentum update, Nesterov Momentum
-        m_prev = self.m
-        self.m = self.beta * m_prev - self.lr * round_agg
-        self.global_model += - self.beta * m_prev + (1 + self.beta) * self.m
+        # Momentum update, Nesterov Momentum, in place on the flat buffers:
+        # m = beta * m_prev - lr * round_agg, w += - beta * m_prev + (1 + beta) * m
+        _nesterov_step(self._flat_params, self._m_flat, round_agg, self.beta, self.lr, self._tmp_buf)
 
-        return self.global_model, self.m
+        # snapshots, the internal buffers keep changing with later rounds
+        return self.global_model.copy(), self.m.copy()
 
     def get_mutual_mi(self):
         """
@@ -118,34 +255,53 @@ class MI(ServerAgg):
         Returns:
             - MI:                       (np.ndarray} the corresponding MI value between client model and golobal model
         """
-        mutual_mi = np.zeros(shape=(len(self.clients_model), len(self.clients_model)))
-        for i in range(len(self.clients_model)):
-            self.model.set_params(self.clients_model[i])
-            client_out_i = self.model.forward(self.unlabel)
-            client_exp_i = client_out_i.mean(dim=1, keepdim=True) # the expectation of model output
-            for j in range(i+1, len(self.clients_model)):
-                self.model.set_params(self.clients_model[j])
-                client_out_j = self.model.forward(self.unlabel)
-                client_exp_j = client_out_j.mean(dim=1, keepdim=True)  # the expectation of model output
-
-                rho = torch.sum((client_out_i - client_exp_i) * (client_out_j - client_exp_j), dim=1) / \
-                      torch.sqrt(torch.sum(torch.square((client_out_i - client_exp_i)), dim=1) * \
-                                 torch.sum(torch.square(client_out_j - client_exp_j), dim=1))
-
-                intermediate = 1 - pow(rho.mean().item(), 2)
-                # prevent math domain error
-                if intermediate < 1e-300:
-                    intermediate += 1e-300
-                try:
-                    log(intermediate)
-                except ValueError:
-                    print("the intermediate value is ",intermediate)
-                mi = - log(intermediate) / 2
-
-                mutual_mi[i, j] = mi
-                mutual_mi[j, i] = mi
-        avg_mi = np.mean(mutual_mi, axis=1)
-        return avg_mi
+        # forward each client model over the unlabeled data exactly once, and cache only its centred,
+        # normalised output so every pair below reduces to a dot product. The forwards run without
+        # autograd and with dropout off, but BatchNorm keeps its mode: set_params does not move the
+        # running stats, so normalising with this node's own stats would skew every client's output.
+        # The buffers BatchNorm updates in train mode are restored afterwards
+        buffers = [b.clone() for b in self.model.buffers()]
+        dropouts = [m for m in self.model.modules()
+                    if isinstance(m, torch.nn.modules.dropout._DropoutNd) and m.training]
+        for m in dropouts:
+            m.eval()
+        outs = []
+        try:
+            with torch.inference_mode():
+                for client_model in self.clients_model:
+                    self.model.set_params(client_model)
+                    out = self.model.forward(self.unlabel)
+                    out = out - out.mean(dim=1, keepdim=True)  # centre by the expectation of model output
+                    out = out / torch.sqrt(torch.sum(torch.square(out), dim=1, keepdim=True) + 1e-12)
+                    if self.out_dtype is not None:
+                        out = out.to(self.out_dtype)  # only the unit-norm output is cast down
+                    outs.append(out)
+        finally:
+            with torch.no_grad():
+                for b, saved in zip(self.model.buffers(), buffers):
+                    b.copy_(saved)
+            for m in dropouts:
+                m.train()
+        client_outs = torch.stack(outs)  # [N, batch_size, output_shape]
+
+        if self.estimator == 'binary':
+            bits = (client_outs > 0).reshape(len(self.clients_model), -1).cpu().numpy()
+            mutual_mi = torch.from_numpy(binary_mutual_info(bits))
+        else:
+            # pairwise correlation of every client pair, averaged over the unlabeled samples,
+            # the whole N x N grid is a single contraction over (b, d)
+            rho = torch.einsum('nbd,mbd->nm', client_outs, client_outs) / client_outs.shape[1]
+            # MI = -log(1 - rho^2) / 2 on device, clamping rho^2 just below 1 in its own precision
+            rho = rho.to(torch.promote_types(rho.dtype, torch.float32))
+            rho2 = torch.square(rho).clamp(max=1 - torch.finfo(rho.dtype).eps)
+            mutual_mi = -0.5 * torch.log1p(-rho2)
+        mutual_mi.fill_diagonal_(0)
+        # a client whose outputs are not finite gets a nan MI, and is left out of the others' averages
+        finite = torch.isfinite(client_outs.flatten(1)).all(dim=1).to(mutual_mi.device)
+        mutual_mi[:, ~finite] = 0
+        avg_mi = mutual_mi.sum(dim=1) / finite.sum()
+        avg_mi[~finite] = float('nan')
+        return avg_mi.cpu().numpy()
 
 class Bicotti(ServerAgg):
     def __init__(self, global_model, beta, slr):
@@ -156,10 +312,14 @@ class Bicotti(ServerAgg):
             - beta:                      {float} the hyperparameter when the compress mode is on
             - slr:                       {float} the server side learning rate
         """
-        self.global_model = NumpyModel(global_model)
+        self.shapes = [np.shape(p) for p in global_model]
+        self._flat_params = _flat_copy(global_model)
+        self.global_model = NumpyModel.from_flat(self._flat_params, self.shapes)
         self.beta = beta
         self.lr = slr
         self.m = self.global_model.zeros_like()
+        self._agg_buf = np.zeros_like(self._flat_params) # reused by repeated apply_gradients calls
+        self._tmp_buf = np.zeros_like(self._flat_params)
 
     def apply_gradients(self, clients_grads):
         """
@@ -178,26 +338,24 @@ class Bicotti(ServerAgg):
         self.clients_grads = clients_grads
 
         # Euclidean distance calculation
-        dists = np.zeros(shape=(len(self.clients_grads), len(self.clients_grads)))
-        for i in range(len(self.clients_grads)):
-            for j in range(i+1, len(self.clients_grads)):
-                dist = sum_model_L2_distance(self.clients_grads[i], self.clients_grads[j])
-                dists[i, j] = dist
-                dists[j, i] = dist
-
-        dists = np.sort(dists)
+        sizes = [np.size(p) for p in self.clients_grads[0]]
+        G = self._stack_grads(self.clients_grads)
+        dists = pairwise_sum_L2_distance(G, sizes)
+
         f = int(len(self.clients_grads) / 3)    # the theoretic f value
         R = len(self.clients_grads) # the total number of updates
         select = R - f - 2
-        scores = np.sum(dists[:, :select+1], axis=1) # sum value of Euclidean distance of closet R-f-2 updates
-        scores_sort_idx = np.argsort(scores)
+        # only the set of the select+1 smallest distances of each row matters, not their order
+        closest = np.partition(dists, max(select, 0), axis=1)[:, :select+1]
+        scores = np.sum(closest, axis=1) # sum value of Euclidean distance of closet R-f-2 updates
 
-        round_agg = self.global_model.zeros_like()
         # Select the R-f clients with the lowest scores
-        for i in range(R - f):
-            round_agg += self.clients_grads[scores_sort_idx[i]]
-        N = R - f
-        round_agg = round_agg / N
+        top_idx = np.argpartition(scores, R - f - 1)[:R - f]
+        w = np.zeros(R)
+        w[top_idx] = 1 / (R - f)
+        round_agg = _weighted_mean(G, w, out=self._agg_buf, tmp=self._tmp_buf)
 
-        self.global_model += - self.lr * round_agg
-        return self.global_model
\ No newline at end of file
+        round_agg *= self.lr
+        self._flat_params -= round_agg
+        # a snapshot, the internal buffer keeps changing with later rounds
+        return self.global_model.copy()
\ No newline at end of file
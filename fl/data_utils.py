@@ -11,6 +11,7 @@ import os
 import json
 import h5py
 import scipy.sparse
+from scipy.spatial.distance import cdist
 import idx2numpy
 from torchvision import datasets, transforms
 
@@ -385,6 +386,66 @@ def sum_model_L2_distance(x, y):
     sqrts = [np.sqrt(s) for s in sums]
     return np.sum(sqrts)
     
+def pairwise_sum_L2_distance(G, sizes):
+    """
+    Vectorised sum_model_L2_distance between every pair of flattened models.
+
+    Args:
+    - G:     {np.ndarray} of shape [N, P], each row is a flattened model
+    - sizes: {list of int} number of values in each layer of the models
+
+    Returns: {np.ndarray} of shape [N, N], the sum L2 distance of each pair.
+    """
+    dists = np.zeros(shape=(G.shape[0], G.shape[0]))
+    offset = 0
+    for size in sizes:
+        layer = G[:, offset:offset+size]
+        dists += cdist(layer, layer, 'euclidean')
+        offset += size
+    return dists
+    
+if hasattr(np, 'bitwise_count'):
+    _popcount = np.bitwise_count
+else:
+    _POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+    def _popcount(words):
+        counts = _POPCOUNT_TABLE[words.view(np.uint8)]
+        return counts.reshape(words.shape + (-1,)).sum(axis=-1)
+
+def binary_mutual_info(bits):
+    """
+    Pairwise mutual information between binary variables, estimated from the
+    2x2 joint histogram of each pair. The joint counts are computed with
+    popcounts on the bits packed into uint64 words.
+
+    Args:
+    - bits: {np.ndarray} bool of shape [N, M], row i holds M observations of
+            variable i
+
+    Returns: {np.ndarray} of shape [N, N], the MI (in nats) of each pair.
+    """
+    N, M = bits.shape
+    packed = np.packbits(bits, axis=1)
+    packed = np.pad(packed, ((0, 0), (0, -packed.shape[1] % 8))) # zero padding bits are never counted
+    words = packed.view(np.uint64)
+
+    n1 = bits.sum(axis=1)
+    n11 = _popcount(words[:, None, :] & words[None, :, :]).sum(axis=-1, dtype=np.int64)
+    n10 = n1[:, None] - n11
+    n01 = n1[None, :] - n11
+    n00 = M - n11 - n10 - n01
+
+    p1 = n1 / M
+    p0 = 1 - p1
+    mi = np.zeros(shape=(N, N))
+    for n_ab, p_a, p_b in ((n11, p1, p1), (n10, p1, p0), (n01, p0, p1), (n00, p0, p0)):
+        p_ab = n_ab / M
+        with np.errstate(divide='ignore', invalid='ignore'):
+            terms = p_ab * np.log(p_ab / np.outer(p_a, p_b))
+        mi += np.where(p_ab > 0, terms, 0.0)  # 0 * log(0) = 0
+    return mi
+    
 def n_bits(array):
     """
     Args:
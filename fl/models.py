@@ -51,7 +51,8 @@ class FLModel(torch.nn.Module):
         
     def set_params(self, new_params):
         """
-        Set all the parameters of this model (values are copied).
+        Set all the parameters of this model (values are copied once, straight
+        from new_params into the model's parameters).
         
         Args:
         - new_params: {list, NumpyModel} all ndarrays must be same shape as 
@@ -59,7 +60,7 @@ class FLModel(torch.nn.Module):
         """
         with torch.no_grad():
             for (p, new_p) in zip(self.parameters(), new_params):
-                p.copy_(torch.tensor(new_p))
+                p.copy_(torch.as_tensor(new_p))
    
     def forward(self, x):
         """
@@ -296,16 +297,51 @@ class NumpyModel():
     A convenient class for containing an entire model/set of optimiser values. 
     Operations (+, -, *, /, **) can then be done on a whole model/set of values 
     conveniently.
+    
+    When all values are Numpy ndarrays of one dtype they are packed into one 
+    contiguous 1-D buffer (self.flat) and self.params are views into it, so 
+    each operation is a single vectorised op over the whole model instead of 
+    one per layer.
     """
     
     def __init__(self, params):
         """
-        Returns a new NumpyModel.
+        Returns a new NumpyModel. Numpy ndarray params sharing one dtype are 
+        copied into a single flat buffer, other params (e.g. pytorch tensors or
+        mixed dtypes) are kept as given.
         
         Args:
         - params:  {list} of Numpy ndarrays/pytorch tensors 
         """
-        self.params = params
+        if (len(params) > 0 and all(isinstance(p, np.ndarray) for p in params)
+                and len(set(p.dtype for p in params)) == 1):
+            self.shapes = [p.shape for p in params]
+            self.flat   = np.concatenate([np.ravel(p) for p in params])
+            self.params = self._views(self.flat, self.shapes)
+        else:
+            self.shapes = None
+            self.flat   = None
+            self.params = params
+        
+    @staticmethod
+    def _views(flat, shapes):
+        """
+        Return a list of views into flat with the given shapes.
+        """
+        params = []
+        offset = 0
+        for shape in shapes:
+            size = int(np.prod(shape))
+            params.append(flat[offset:offset+size].reshape(shape))
+            offset += size
+        return params
+        
+    def _is_flat_like(self, other):
+        """
+        Return True if self and other are both flat-backed with the same layout.
+        """
+        return (self.flat is not None and other.flat is not None 
+                and self.shapes == other.shapes)
         
     def _op(self, other, f):
         """
@@ -320,9 +356,13 @@ class NumpyModel():
         The NumpyModel produced as a result of applying f to self and other.
         """
         if isinstance(other, numbers.Number):
+            if self.flat is not None:
+                return NumpyModel.from_flat(f(self.flat, other), self.shapes)
             new_params = [f(p, other) for p in self.params]
             
         elif isinstance(other, NumpyModel):
+            if self._is_flat_like(other):
+                return NumpyModel.from_flat(f(self.flat, other.flat), self.shapes)
             new_params = [f(p, o) for (p, o) in zip(self.params, other.params)]
             
         else:
@@ -330,6 +370,29 @@ class NumpyModel():
         
         return NumpyModel(new_params)
         
+    def _iop(self, other, f, f_inplace):
+        """
+        As _op, but when self is flat-backed and the result keeps its dtype, 
+        f_inplace updates the values of this NumpyModel instead of allocating a
+        new one. Otherwise falls back to _op, i.e. self is rebound to a new 
+        NumpyModel and the caller's arrays/tensors are left untouched.
+        """
+        if self.flat is not None:
+            if isinstance(other, numbers.Number):
+                operand, sample = other, other
+            elif isinstance(other, NumpyModel) and self._is_flat_like(other):
+                operand, sample = other.flat, other.flat[:0]
+            else:
+                operand, sample = None, None
+            
+            # apply f to an empty slice to find the dtype of the result
+            if (operand is not None 
+                    and f(self.flat[:0], sample).dtype == self.flat.dtype):
+                f_inplace(self.flat, operand)
+                return self
+        
+        return self._op(other, f)
+        
     def __array_ufunc__(self, *args, **kwargs):
         """
         If an operation between a Numpy scalar/array and a NumpyModel has the 
@@ -350,18 +413,49 @@ class NumpyModel():
         """
         Return a new NumpyModel with copied values.
         """
+        if self.flat is not None:
+            return NumpyModel.from_flat(np.copy(self.flat), self.shapes)
         return NumpyModel([np.copy(p) for p in self.params])
         
     def abs(self):
         """
         Return a new NumpyModel with all absolute values.
         """
+        if self.flat is not None:
+            return NumpyModel.from_flat(np.abs(self.flat), self.shapes)
         return NumpyModel([np.abs(p) for p in self.params])
         
+    def to_flat(self):
+        """
+        Return all params concatenated into a single 1-D Numpy ndarray (values
+        are copied).
+        """
+        if self.flat is not None:
+            return np.copy(self.flat)
+        return np.concatenate([np.ravel(p) for p in self.params])
+        
+    @staticmethod
+    def from_flat(flat, shapes):
+        """
+        Return a new NumpyModel whose params are views into flat (values are 
+        not copied), so in-place changes to flat are seen by the NumpyModel.
+        
+        Args:
+        - flat:     {np.ndarray} 1-D values, as returned by to_flat
+        - shapes:   {list of tuples} the shape of each param
+        """
+        model = NumpyModel([])
+        model.shapes = [tuple(shape) for shape in shapes]
+        model.flat   = flat
+        model.params = NumpyModel._views(flat, model.shapes)
+        return model
+        
     def zeros_like(self):
         """
         Return a new NumpyModel with same shape, but with 0-filled params.
         """
+        if self.flat is not None:
+            return NumpyModel.from_flat(np.zeros_like(self.flat), self.shapes)
         return NumpyModel([np.zeros_like(p) for p in self.params])
         
     def __add__(self, other):
@@ -375,6 +469,12 @@ class NumpyModel():
         Return the NumpyModel resulting from the addition of other and self.
         """
         return self._op(other, operator.add)
+        
+    def __iadd__(self, other):
+        """
+        Add other to self in place.
+        """
+        return self._iop(other, operator.add, operator.iadd)
 
     def __sub__(self, other):
         """
@@ -382,6 +482,12 @@ class NumpyModel():
         """
         return self._op(other, operator.sub)
         
+    def __isub__(self, other):
+        """
+        Subtract other from self in place.
+        """
+        return self._iop(other, operator.sub, operator.isub)
+        
     def __mul__(self, other):
         """
         Return the NumpyModel resulting from the multiply of self and other.
@@ -394,12 +500,24 @@ class NumpyModel():
         """
         return self._op(other, operator.mul)
         
+    def __imul__(self, other):
+        """
+        Multiply self by other in place.
+        """
+        return self._iop(other, operator.mul, operator.imul)
+        
     def __truediv__(self, other):
         """
         Return the NumpyModel resulting from the division of self by other.
         """
         return self._op(other, operator.truediv)
         
+    def __itruediv__(self, other):
+        """
+        Divide self by other in place.
+        """
+        return self._iop(other, operator.truediv, operator.itruediv)
+        
     def __pow__(self, other):
         """
         Return the NumpyModel resulting from taking self to the power of other.